@@ -1,20 +1,135 @@
+import gzip
+import io
 import os
+import queue
+import re
 import requests
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain, islice
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from requests.adapters import HTTPAdapter
 from signal import signal, SIGINT
 
 
 stop = False
 
+# Matches the attributes (column 9 of a GFF line) that AnnotationLine keeps
+_ATTR_RE = re.compile(r"(?:^|;)(ko|cog|product|ec_number|pfam)=([^;\r\n]*)")
+
+# Matches only the attributes that are counted by the aggregation (on raw bytes).
+# Anchoring on the tab or semicolon in front of the key lets it scan the whole
+# line, so the columns never have to be split apart.
+_TERM_RE = re.compile(rb"[\t;](ko|cog|pfam)=([^;\t\r\n]*)")
+
 
 def sig_handler(signalnumber, frame):
     global stop
     stop = True
 
 
+def get_functional_attributes(line):
+    """
+    Get the raw ko, cog and pfam attribute values of a GFF line
+    input: GFF line as bytes (the attributes are ASCII, so there is no need to decode)
+    returns: dict of attribute key to raw value, empty if the line has no KO annotation
+    """
+    if line.find(b"ko=") <= 0:
+        return {}
+    return dict(_TERM_RE.findall(line))
+
+
+def count_functional_attributes(lines):
+    """
+    Count the raw ko, cog and pfam attribute values of GFF lines in one C-level pass
+    input: iterable of GFF lines as bytes
+    returns: Counter of (key, value) attribute pairs
+    """
+    return Counter(chain.from_iterable(map(dict.items, map(get_functional_attributes, lines))))
+
+
+def expand_functional_terms(key, value):
+    """
+    Turn a raw ko, cog or pfam attribute value into its prefixed terms
+    input: attribute key and raw value as bytes
+    returns: list of prefixed terms as bytes
+    """
+    if key == b"ko":
+        return value.replace(b"KO:", b"KEGG.ORTHOLOGY:").rstrip().split(b',')
+    if key == b"cog":
+        return [b'COG:' + cog_id for cog_id in value.split(b',')]
+    return [b'PFAM:' + pfam_id for pfam_id in value.split(b",")]
+
+
+def get_functional_terms(line):
+    """
+    Get the KEGG, COG and Pfam terms of a GFF line without building an AnnotationLine
+    input: GFF line as bytes
+    returns: list of prefixed terms as bytes, empty if the line has no KO annotation
+    """
+    attributes = get_functional_attributes(line)
+    terms = []
+    for key in (b"ko", b"cog", b"pfam"):
+        if key in attributes:
+            terms += expand_functional_terms(key, attributes[key])
+    return terms
+
+
+def prefetch_lines(lines, batch_size=10000, max_batches=4):
+    """
+    Read lines on a background thread so the download overlaps the parsing
+    input: iterable of lines, lines per batch, batches buffered ahead of the consumer
+    returns: generator over the same lines; if it is closed early, the reader
+             stops and closes the source (e.g. the HTTP response) if it can
+    """
+    batches = queue.Queue(maxsize=max_batches)
+    stopped = threading.Event()
+
+    def put(item):
+        # give up instead of blocking forever once the consumer is gone
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            lines_iter = iter(lines)
+            for batch in iter(lambda: list(islice(lines_iter, batch_size)), []):
+                if not put(batch):
+                    break
+            else:
+                put(None)
+        except Exception as ex:
+            put(ex)
+        if stopped.is_set() and hasattr(lines, "close"):
+            lines.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        stopped.set()
+
+
 class AnnotationLine():
+    __slots__ = ('id', 'kegg', 'cogs', 'product', 'ec_numbers', 'pfams')
 
     def __init__(self, line, filter=None):
+        """
+        input: GFF line, optional set (ideally a frozenset) of gene IDs to keep
+        """
         self.id = None
         self.kegg = None
         self.cogs = None
@@ -23,23 +138,39 @@ class AnnotationLine():
         self.pfams = None
 
         if line.find("ko=") > 0:
-            annotations = line.split("\t")[8].split(";")
-            self.id = annotations[0][3:]
+            # only split off the first nine columns and check the ID before scanning
+            attributes = line.split("\t", 9)[8]
+            self.id = attributes.partition(";")[0][3:]
             if filter and self.id not in filter:
                 return
 
-            for anno in annotations:
-                if anno.startswith("ko="):
-                    kos = anno[3:].replace("KO:", "KEGG.ORTHOLOGY:")
-                    self.kegg = kos.rstrip().split(',')
-                elif anno.startswith("cog="):
-                    self.cogs = ['COG:' + cog_id for cog_id in anno[4:].split(',')]
-                elif anno.startswith("product="):
-                    self.product = anno[8:]
-                elif anno.startswith("ec_number="):
-                    self.ec_numbers = anno[10:].split(",")
-                elif anno.startswith("pfam="):
-                    self.pfams = ['PFAM:' + pfam_id for pfam_id in anno[5:].split(",")]
+            for key, value in _ATTR_RE.findall(attributes):
+                self._HANDLERS[key](self, value)
+
+    def _set_kegg(self, value):
+        kos = value.replace("KO:", "KEGG.ORTHOLOGY:")
+        self.kegg = kos.rstrip().split(',')
+
+    def _set_cogs(self, value):
+        self.cogs = ['COG:' + cog_id for cog_id in value.split(',')]
+
+    def _set_product(self, value):
+        self.product = value
+
+    def _set_ec_numbers(self, value):
+        self.ec_numbers = value.split(",")
+
+    def _set_pfams(self, value):
+        self.pfams = ['PFAM:' + pfam_id for pfam_id in value.split(",")]
+
+    # attribute key -> setter, for every key matched by _ATTR_RE
+    _HANDLERS = {
+        "ko": _set_kegg,
+        "cog": _set_cogs,
+        "product": _set_product,
+        "ec_number": _set_ec_numbers,
+        "pfam": _set_pfams,
+    }
 
 
 class MetaGenomeFuncAgg():
@@ -47,6 +178,19 @@ class MetaGenomeFuncAgg():
     _base_url = "https://data.microbiomedata.org/data"
     _BASE_PATH_ENV = "NMDC_BASE_PATH"
     _base_dir = "/global/cfs/cdirs/m3408/results"
+    _BUFFER_SIZE = 1 << 20
+    _WORKERS_ENV = "NMDC_AGG_WORKERS"
+    _workers = 8
+    _INSERT_BATCH_SIZE = 5000
+    # data object IDs looked up per query by load_gff_urls
+    _DATA_OBJECT_CHUNK_SIZE = 1000
+    # most aggregated IDs excluded by the execution query itself
+    _MAX_NIN_IDS = 50000
+    # executions queued per worker thread during a sweep
+    _IN_FLIGHT_PER_WORKER = 2
+    # GFFs at least this large are downloaded as parallel byte ranges
+    _RANGE_MIN_SIZE = 1 << 30
+    _RANGE_PARTS = 4
 
     def __init__(self):
         url = os.environ["MONGO_URL"]
@@ -56,40 +200,118 @@ class MetaGenomeFuncAgg():
         self.do_col = self.db.data_object_set
         self.base_url = os.environ.get(self._BASE_URL_ENV, self._base_url)
         self.base_dir = os.environ.get(self._BASE_PATH_ENV, self._base_dir)
+        self.workers = int(os.environ.get(self._WORKERS_ENV, self._workers))
+        # one pooled connection per range read of every worker thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.workers * self._RANGE_PARTS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # GFF data object ID -> URL, filled in by load_gff_urls
+        self.gff_urls = None
 
     def get_functional_annotation_counts(self, url):
         fn = url.replace(self.base_url, self.base_dir)
 
+        # Read raw bytes from either source and only decode the distinct terms
         if os.path.exists(fn):
-            lines = open(fn)
+            with open(fn, "rb", buffering=self._BUFFER_SIZE) as lines:
+                attribute_counts = count_functional_attributes(lines)
         else:
-            s = requests.Session()
-            resp = s.get(url, headers=None, stream=True)
-            if not resp.ok:
-                raise OSError(f"Failed to read {url}")
-            lines = resp.iter_lines()
-
-        func_count = {}
-        for line in lines:
-            if isinstance(line, bytes):
-                line = line.decode()
-            anno = AnnotationLine(line)
-            if anno.kegg:
-                for ko in anno.kegg:
-                    if ko not in func_count:
-                        func_count[ko] = 0
-                    func_count[ko] += 1
-            if anno.cogs:
-                for cog in anno.cogs:
-                    if cog not in func_count:
-                        func_count[cog] = 0
-                    func_count[cog] += 1
-            if anno.pfams:
-                for pfam in anno.pfams:
-                    if pfam not in func_count:
-                        func_count[pfam] = 0
-                    func_count[pfam] += 1
-        return func_count
+            size = self.get_range_size(url)
+            if size:
+                attribute_counts = self.count_range_attributes(url, size)
+            else:
+                headers = {"Accept-Encoding": "gzip"}
+                resp = self.session.get(url, headers=headers, stream=True)
+                if not resp.ok:
+                    raise OSError(f"Failed to read {url}")
+                attribute_counts = count_functional_attributes(prefetch_lines(self.open_response(resp)))
+
+        # Split and prefix each distinct value once rather than once per line
+        func_count = Counter()
+        for (key, value), count in attribute_counts.items():
+            for term in expand_functional_terms(key, value):
+                func_count[term] += count
+        return {term.decode(): count for term, count in func_count.items()}
+
+    def get_range_size(self, url):
+        """
+        Check whether a GFF is large enough to be downloaded in parallel byte ranges
+        input: GFF URL
+        returns: size in bytes, or None if it should be streamed in one request
+        """
+        resp = self.session.head(url, headers={"Accept-Encoding": "identity"}, allow_redirects=True)
+        size = int(resp.headers.get("Content-Length") or 0)
+        if resp.ok and resp.headers.get("Accept-Ranges") == "bytes" and size >= self._RANGE_MIN_SIZE:
+            return size
+        return None
+
+    def count_range_attributes(self, url, size):
+        """
+        Count the attributes of a GFF by downloading its byte ranges concurrently
+        input: GFF URL, size in bytes
+        returns: Counter of (key, value) attribute pairs
+        """
+        step = -(-size // self._RANGE_PARTS)
+        bounds = [(start, min(start + step, size)) for start in range(0, size, step)]
+        with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+            counts = executor.map(
+                lambda bound: count_functional_attributes(self.read_range(url, *bound)), bounds
+            )
+            return sum(counts, Counter())
+
+    def read_range(self, url, start, end):
+        """
+        Read the lines of a GFF that start within a byte range
+        input: GFF URL, first byte of the range, byte after the end of the range
+        returns: generator over the lines as bytes
+        """
+        # start one byte early to tell whether the range begins on a line boundary
+        offset = max(start - 1, 0)
+        headers = {"Range": f"bytes={offset}-", "Accept-Encoding": "identity"}
+        resp = self.session.get(url, headers=headers, stream=True)
+        if resp.status_code != 206:
+            raise OSError(f"Failed to read bytes {start}-{end} of {url}")
+        try:
+            reader = self.open_response(resp)
+            if start > 0:
+                # the line running into this range belongs to the previous one
+                offset += len(reader.readline())
+            for line in reader:
+                if offset >= end:
+                    break
+                yield line
+                offset += len(line)
+        finally:
+            resp.close()
+
+    def open_response(self, resp):
+        """
+        Wrap a streamed response in a buffered reader so lines are split in C
+        input: streamed requests response
+        returns: binary file object over the (decompressed) body
+        """
+        # urllib3 cannot decode gzip into a caller's buffer, so gunzip ourselves
+        resp.raw.decode_content = False
+        if resp.headers.get("Content-Encoding") == "gzip":
+            return gzip.GzipFile(fileobj=resp.raw)
+        return io.BufferedReader(resp.raw, self._BUFFER_SIZE)
+
+    def load_gff_urls(self, execution_records):
+        """
+        Look up the GFF annotation URLs of the given executions with a few batched
+        queries so that find_anno no longer has to query once per workflow execution
+        input: list of workflow execution records
+        """
+        do_ids = list(dict.fromkeys(doid for rec in execution_records for doid in rec['has_output']))
+        self.gff_urls = {}
+        for i in range(0, len(do_ids), self._DATA_OBJECT_CHUNK_SIZE):
+            q = {
+                "id": {"$in": do_ids[i:i + self._DATA_OBJECT_CHUNK_SIZE]},
+                "data_object_type": "Functional Annotation GFF",
+            }
+            cursor = self.do_col.find(q, {"_id": 0, "id": 1, "url": 1}).batch_size(10000)
+            self.gff_urls.update((do['id'], do['url']) for do in cursor)
 
     def find_anno(self, dos):
         """
@@ -97,16 +319,15 @@ class MetaGenomeFuncAgg():
         input: list of data object IDs
         returns: GFF functional annotation URL
         """
-        url = None
+        urls = self.gff_urls
+        if urls is None:
+            q = {"id": {"$in": list(dos)}, "data_object_type": "Functional Annotation GFF"}
+            urls = {do['id']: do['url'] for do in self.do_col.find(q, {"_id": 0, "id": 1, "url": 1})}
+        # keep the order of the data object IDs when there is more than one match
         for doid in dos:
-            do = self.do_col.find_one({"id": doid})
-            # skip over bad records
-            if not do or 'data_object_type' not in do:
-                continue
-            if do['data_object_type'] == 'Functional Annotation GFF':
-                url = do['url']
-                break
-        return url
+            if doid in urls:
+                return urls[doid]
+        return None
 
     def process_workflow_execution(self, execution_record):
         url = self.find_anno(execution_record['has_output'])
@@ -129,28 +350,76 @@ class MetaGenomeFuncAgg():
 
     def sweep(self):
         print("Getting list of indexed objects")
-        done = self.agg_col.distinct("was_generated_by")
-        q = {"type": {
-            "$in": ["nmdc:MetagenomeAnnotation", "nmdc:MetatranscriptomeAnnotation"]
-        }}
-        execution_records = self.db.workflow_execution_set.find(q)
-        for execution_record in execution_records:
-            if execution_record['id'] in done:
-                continue
-            try:
-                rows = self.process_workflow_execution(execution_record)
-            except Exception as ex:
-                # Continue on errors
-                print(ex)
-                continue
-            if len(rows) > 0:
-                print(' - %s' % (str(rows[0])))
-                self.agg_col.insert_many(rows)
-            else:
-                print(f' - No rows for {execution_record["id"]}')
+        # stream the distinct ids in batches instead of one 16MB-limited distinct reply
+        pipeline = [{"$group": {"_id": "$was_generated_by"}}]
+        done = {
+            rec['_id']
+            for rec in self.agg_col.aggregate(pipeline, allowDiskUse=True, batchSize=10000)
+        }
+        q = {
+            "type": {
+                "$in": ["nmdc:MetagenomeAnnotation", "nmdc:MetatranscriptomeAnnotation"]
+            },
+        }
+        # let the server skip the aggregated records while the id list stays well below the
+        # 16MB query document limit, beyond that skip them here as the records stream in
+        if len(done) <= self._MAX_NIN_IDS:
+            q["id"] = {"$nin": list(done)}
+        projection = {"_id": 0, "id": 1, "has_output": 1}
+        cursor = self.db.workflow_execution_set.find(q, projection).batch_size(100)
+        execution_records = [rec for rec in cursor if rec['id'] not in done]
+        if execution_records:
+            self.load_gff_urls(execution_records)
+
+        # download and count on worker threads, insert from this thread only
+        pending = []
+        records = iter(execution_records)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # only queue a few executions per worker and drop each one once its rows are taken,
+            # so memory is bounded by the number of workers rather than the backlog
+            futures = {
+                executor.submit(self.process_workflow_execution, execution_record): execution_record
+                for execution_record in islice(records, self._IN_FLIGHT_PER_WORKER * self.workers)
+            }
+            while futures and not stop:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    execution_record = futures.pop(future)
+                    if not stop:
+                        next_record = next(records, None)
+                        if next_record is not None:
+                            futures[executor.submit(self.process_workflow_execution, next_record)] = next_record
+                    try:
+                        rows = future.result()
+                    except Exception as ex:
+                        # Continue on errors
+                        print(ex)
+                        continue
+                    if len(rows) > 0:
+                        print(' - %s' % (str(rows[0])))
+                        # all rows of an execution go into the same insert
+                        pending.extend(rows)
+                        if len(pending) >= self._INSERT_BATCH_SIZE:
+                            self.insert_rows(pending)
+                            pending = []
+                    else:
+                        print(f' - No rows for {execution_record["id"]}')
             if stop:
                 print("quiting")
-                break
+                executor.shutdown(wait=True, cancel_futures=True)
+        if pending:
+            self.insert_rows(pending)
+
+    def insert_rows(self, rows):
+        """
+        Insert aggregation rows of one or more workflow executions
+        input: list of aggregation rows
+        """
+        try:
+            # unordered so one bad row does not abort the rest of the batch
+            self.agg_col.insert_many(rows, ordered=False)
+        except BulkWriteError as ex:
+            print(f' - {len(ex.details["writeErrors"])} rows failed to insert')
 
 
 if __name__ == "__main__":
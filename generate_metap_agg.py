@@ -1,9 +1,19 @@
 import requests
+import base64
 import csv
+import hashlib
 import io
+import json
 import os
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import Counter
 import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR)
@@ -21,7 +31,9 @@ class Aggregator(ABC):
         Base URL for the API, either production or development
         "https://api.microbiomedata.org" or "https://api-dev.microbiomedata.org"
     nmdc_api_token : str
-        API bearer token to access the API
+        API bearer token to access the API, fetched on first use and refreshed when it expires
+    session : requests.Session
+        HTTP session shared by all requests so that connections are kept alive and reused
     aggregation_filter : str
         Filter to apply to the aggregation collection endpoint to get applicable records (set in subclasses)
         Note the use of the ^ character to match the beginning of the string which optimizes the query
@@ -29,19 +41,112 @@ class Aggregator(ABC):
     workflow_filter : str
         Filter to apply to the workflow collection endpoint to get applicable records (set in subclasses)
         e.g. '{"type":"nmdc:MetaproteomicsAnalysis"}'
+    max_workers : int
+        Number of workflow records processed concurrently during a sweep
     """
 
     # Set the base URL for the API
     _NMDC_API_URL = "https://api-dev.microbiomedata.org"
 
+    # Set the default number of workflow records processed concurrently
+    _NMDC_AGG_WORKERS = 8
+
+    # Set the number of workflow records queued per worker thread during a sweep
+    _IN_FLIGHT_PER_WORKER = 2
+
+    # Refresh the bearer token this many seconds before it actually expires
+    _TOKEN_EXPIRY_MARGIN = 60
+
+    # Set the maximum number of records from several workflows combined into a single submission
+    # request (a workflow with more records is submitted on its own, never split)
+    _SUBMIT_CHUNK_SIZE = 2000
+
+    # Set the maximum number of get_results queries kept in the results cache
+    _RESULTS_CACHE_SIZE = 128
+
+    # Set the workflow execution fields requested from the API (the ones sweep and process_activity use);
+    # subclasses whose process_activity reads more fields extend it
+    _WORKFLOW_FIELDS = "id,has_output"
+
     def __init__(self):
         self.base_url = os.getenv("NMDC_API_URL") or self._NMDC_API_URL
-        self.get_bearer_token()
+        self.max_workers = int(os.getenv("NMDC_AGG_WORKERS") or self._NMDC_AGG_WORKERS)
+        # Every worker can have a request open while a page prefetch (see _iter_results) is running
+        self.session = self.create_session(pool_maxsize=2 * self.max_workers)
+
+        # The bearer token is requested lazily by the nmdc_api_token property
+        self._nmdc_api_token = None
+        self._token_expiry = 0
+        self._token_lock = threading.Lock()
+
+        # Results of get_results keyed by query, see invalidate_cache
+        self._results_cache = {}
+        self._results_cache_lock = threading.Lock()
+
+        # JSON lines file of submitted workflow ids, kept across runs (disabled when unset)
+        self.checkpoint_file = os.getenv("NMDC_AGG_CHECKPOINT")
+
+        # Workflow ids the API listed as aggregated at the start of the last sweep
+        self._aggregated_ids = None
 
         # The following attributes are set in the subclasses
         self.aggregation_filter = ""
         self.workflow_filter = ""
 
+    @staticmethod
+    def create_session(pool_maxsize):
+        """Function to create an HTTP session with connection pooling and retries on rate limiting and transient server errors
+
+        Parameters
+        ----------
+        pool_maxsize : int
+            Number of connections kept open per host, i.e. the most threads expected to share the session
+
+        Returns
+        -------
+        requests.Session
+            Session with a pooled adapter mounted for both http and https
+        """
+        session = requests.Session()
+        retries = Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retries)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    def nmdc_api_token(self):
+        """API bearer token, requested from the /token endpoint only when missing or about to expire"""
+        with self._token_lock:
+            if (
+                self._nmdc_api_token is None
+                or time.time() >= self._token_expiry - self._TOKEN_EXPIRY_MARGIN
+            ):
+                self.get_bearer_token()
+            return self._nmdc_api_token
+
+    @staticmethod
+    def get_token_expiry(token):
+        """Function to read the expiry time from the "exp" claim of a JWT bearer token
+
+        Parameters
+        ----------
+        token : str
+            Bearer token returned by the /token endpoint
+
+        Returns
+        -------
+        float
+            Expiry time in seconds since the epoch, or infinity if the token does not carry one
+            (in which case the token is only refreshed after a 401 response)
+        """
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return float("inf")
+
     def get_bearer_token(self):
         """Function to get the bearer token from the API using the /token endpoint
 
@@ -55,7 +160,7 @@ class Aggregator(ABC):
             "client_secret": os.getenv("NMDC_CLIENT_PW"),
         }
 
-        rv = requests.post(self.base_url + "/token", data=token_request_body)
+        rv = self.session.post(self.base_url + "/token", data=token_request_body)
         token_response = rv.json()
         if "access_token" not in token_response:
             logger.error(
@@ -64,7 +169,8 @@ class Aggregator(ABC):
             raise Exception(
                 f"Getting token failed: {token_response}, Status code: {rv.status_code}"
             )
-        self.nmdc_api_token = token_response["access_token"]
+        self._nmdc_api_token = token_response["access_token"]
+        self._token_expiry = self.get_token_expiry(self._nmdc_api_token)
 
     def get_results(self, collection: str, filter="", max_page_size=100, fields=""):
         """General function to get results from the API using the collection endpoint with optional filter and fields
@@ -84,42 +190,91 @@ class Aggregator(ABC):
             Fields to return in the query, separated by commas without spaces if multiple
             e.g. "id,data_object_type,url"
             Default is an empty string, which returns all fields
+
+        Returns
+        -------
+        list of dict
+            List of all records returned by the query
+
+        Notes
+        -----
+        Results are cached per (collection, filter, max_page_size, fields), so repeating a query
+        (e.g. the workflow records in sweep and sweep_success) does not paginate through the API again.
+        Use invalidate_cache to drop the cached results, or _iter_results to always read from the API.
         """
+        key = (collection, filter, max_page_size, fields)
+        with self._results_cache_lock:
+            cached = self._results_cache.get(key)
+        if cached is not None:
+            return list(cached)
+
+        results = list(
+            self._iter_results(
+                collection=collection,
+                filter=filter,
+                max_page_size=max_page_size,
+                fields=fields,
+            )
+        )
 
-        # Get initial results (before next_page_token is given in the results)
-        result_list = []
-        og_url = f"{self.base_url}/nmdcschema/{collection}?&filter={filter}&max_page_size={max_page_size}&projection={fields}"
-        resp = requests.get(og_url)
-        initial_data = resp.json()
-        results = initial_data.get("resources", [])
-        i = 0
-
-        if results == []:
-            # if no results are returned
-            return result_list
+        with self._results_cache_lock:
+            if len(self._results_cache) >= self._RESULTS_CACHE_SIZE:
+                # drop the oldest query
+                del self._results_cache[next(iter(self._results_cache))]
+            self._results_cache[key] = results
+        return list(results)
+
+    def invalidate_cache(self):
+        """Function to drop all results cached by get_results
+
+        Returns
+        -------
+        None
+        """
+        with self._results_cache_lock:
+            self._results_cache.clear()
 
-        # append first page of results to an empty list
-        for result in results:
-            result_list.append(result)
+    def _iter_results(self, collection: str, filter="", max_page_size=100, fields=""):
+        """Generator version of get_results that yields records one page at a time
 
-        # if there are multiple pages of results returned
-        if initial_data.get("next_page_token"):
-            next_page_token = initial_data["next_page_token"]
+        Only the current page is held in memory, so callers that reduce the records
+        (e.g. to a set of ids) never materialize the full collection.
+        See get_results for a description of the parameters.
 
-            while True:
-                i = i + max_page_size
-                url = f"{self.base_url}/nmdcschema/{collection}?&filter={filter}&max_page_size={max_page_size}&page_token={next_page_token}&projection={fields}"
-                response = requests.get(url)
-                data_next = response.json()
+        Yields
+        ------
+        dict
+            Record returned by the query
+        """
+        # Let requests encode the query string, leaving out empty parameters;
+        # the page token is added once it is known
+        url = f"{self.base_url}/nmdcschema/{collection}"
+        params = {
+            k: v
+            for k, v in (("filter", filter), ("max_page_size", max_page_size), ("projection", fields))
+            if v
+        }
 
-                results = data_next.get("resources", [])
-                result_list.extend(results)
-                next_page_token = data_next.get("next_page_token")
+        def get_page(page_token):
+            return self.session.get(url, params={**params, "page_token": page_token}).json()
 
-                if not next_page_token:
-                    break
+        # Get initial results (before next_page_token is given in the results)
+        resp = self.session.get(url, params=params)
+        data = resp.json()
 
-        return result_list
+        if data.get("resources", []) == []:
+            # if no results are returned
+            return
+
+        # While the caller consumes one page, the next one is already being requested
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            while True:
+                next_page_token = data.get("next_page_token")
+                next_page = prefetch.submit(get_page, next_page_token) if next_page_token else None
+                yield from data.get("resources", [])
+                if next_page is None:
+                    return
+                data = next_page.result()
 
     def get_previously_aggregated_workflow_ids(self):
         """Function to return all ids of workflow execution ids that have already been aggregated.
@@ -128,20 +283,19 @@ class Aggregator(ABC):
 
         Returns
         -------
-        list
-            List of workflow ids that have already been aggregated
+        set
+            Set of workflow ids that have already been aggregated
         """
-        agg_col = self.get_results(
+        agg_col = self._iter_results(
             collection="functional_annotation_agg",
             filter=self.aggregation_filter,
             max_page_size=10000,
             fields="was_generated_by",
         )
-        ids = list(set([x["was_generated_by"] for x in agg_col]))
-        return ids
+        return {x["was_generated_by"] for x in agg_col}
 
     def get_workflow_records(self):
-        """Function to return full workflow execution records in the database
+        """Function to return the workflow execution records in the database, limited to the _WORKFLOW_FIELDS
 
         Returns
         -------
@@ -152,7 +306,7 @@ class Aggregator(ABC):
             collection="workflow_execution_set",
             filter=self.workflow_filter,
             max_page_size=500,
-            fields="",
+            fields=self._WORKFLOW_FIELDS,
         )
         return act_col
 
@@ -168,21 +322,38 @@ class Aggregator(ABC):
         -------
         int
             HTTP status code of the response
+
+        Notes
+        -----
+        If the API rejects the bearer token (401), a new token is requested and the submission is retried once.
         """
         url = f"{self.base_url}/metadata/json:submit"
 
+        token = self.nmdc_api_token
         headers = {
             "accept": "application/json",
-            "Authorization": f"Bearer {self.nmdc_api_token}",
+            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json",
         }
 
-        response = requests.post(url, headers=headers, json=json_records)
+        # Serialize once, compactly, so a retry does not have to re-encode the payload
+        body = json.dumps(json_records, separators=(",", ":")).encode("utf-8")
+
+        response = self.session.post(url, headers=headers, data=body)
+        if response.status_code == 401:
+            with self._token_lock:
+                # Threads rejected at the same time share one refresh: only the first one
+                # still holding the rejected token requests a new one
+                if self._nmdc_api_token == token:
+                    self.get_bearer_token()
+                token = self._nmdc_api_token
+            headers["Authorization"] = f"Bearer {token}"
+            response = self.session.post(url, headers=headers, data=body)
 
         return response.status_code
 
     def read_url_tsv(self, url):
-        """Function to read a TSV file's content from a URL and convert it to a list of dictionaries
+        """Function to stream a TSV file's content from a URL as dictionaries
 
         Parameters
         ----------
@@ -191,79 +362,240 @@ class Aggregator(ABC):
 
         Returns
         -------
-        list
-            List of dictionaries where each dictionary represents a row in the TSV file
-        """
-        response = requests.get(url)
-
-        # Read the TSV content
-        tsv_content = response.content.decode("utf-8")
+        iterator of dict
+            Dictionaries where each dictionary represents a row in the TSV file
 
-        # Use csv.reader to parse the TSV content
-        tsv_reader = csv.reader(io.StringIO(tsv_content), delimiter="\t")
+        Notes
+        -----
+        Rows are parsed while the file downloads, so the full body is never held in memory.
+        The iterator can only be consumed once, and raises requests.HTTPError if the download fails.
+        """
+        with self.session.get(url, stream=True) as response:
+            # Do not parse an error page as if it were the TSV
+            response.raise_for_status()
 
-        # Convert the TSV content to a list of dictionaries
-        tsv_data = []
-        headers = next(tsv_reader)  # Get the headers from the first row
-        for row in tsv_reader:
-            tsv_data.append(dict(zip(headers, row)))
+            # Decode the body as it arrives. The TSV is UTF-8 whatever the server claims, and
+            # only the csv module splits rows (str.splitlines would also break on characters such
+            # as \x1c or \u2028 inside a field)
+            response.raw.decode_content = True
+            text = io.TextIOWrapper(response.raw, encoding="utf-8", newline="")
 
-        return tsv_data
+            # The first row holds the headers
+            yield from csv.DictReader(text, delimiter="\t")
 
     def sweep(self):
         """This is the main action function for the Aggregator class.
 
         It performs the following steps:
         1. Get list of workflow IDs that have already been added to the functional_annotation_agg collection
-        2. Get list of all applicable workflow in the database, as defined by the workflow_filter attribute
-        3. For each workflow that is not in the list of previously aggregated records:
+        2. Get list of applicable workflows in the database (as defined by the workflow_filter attribute)
+           that are not in the list of previously aggregated records
+        3. Run the prepare_sweep hook on those workflows
+        4. For each of those workflows (processed concurrently by up to max_workers threads):
             a. Process the activity according to the process_activity method in the subclass
             b. Prepare a json record for the database with the annotations and counts
-            c. Submit json to the database using the post /metadata/json endpoint
+        5. Submit the json records to the database using the post /metadata/json endpoint, combining
+           the records of several small workflows into one request
 
         Returns
         -------
         None
         """
-        # Get list of workflow IDs that have already been processed
-        mp_wf_in_agg = self.get_previously_aggregated_workflow_ids()
+        # The two queries are independent, so run them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # Get list of workflow IDs that have already been processed
+            agg_future = executor.submit(self.get_previously_aggregated_workflow_ids)
+
+            # Get list of all workflow records
+            wf_future = executor.submit(self.get_workflow_records)
+        self._aggregated_ids = agg_future.result()
+
+        # Keep the workflows that have not been aggregated yet, including the ones submitted
+        # by earlier runs that the API may not return yet
+        mp_wf_in_agg = self._aggregated_ids | self.read_checkpoint()
+        pending = [rec for rec in wf_future.result() if rec["id"] not in mp_wf_in_agg]
+        if pending:
+            self.prepare_sweep(pending)
+
+        # Process the workflows concurrently, since each one is dominated by network I/O,
+        # and submit the finished ones from this thread
+        batch = []
+        batch_size = 0
+        pending_iter = iter(pending)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Only queue a few workflows per worker and drop each one once it is handled, so the
+            # records held in memory are bounded by the number of workers rather than the backlog
+            futures = {
+                executor.submit(self._process, mp_wf_rec): mp_wf_rec
+                for mp_wf_rec in islice(pending_iter, self._IN_FLIGHT_PER_WORKER * self.max_workers)
+            }
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    wf_id = futures.pop(future)["id"]
+                    next_rec = next(pending_iter, None)
+                    if next_rec is not None:
+                        futures[executor.submit(self._process, next_rec)] = next_rec
+
+                    json_records = future.result()
+                    if json_records is None:
+                        continue
+                    if len(json_records) >= self._SUBMIT_CHUNK_SIZE:
+                        # Large workflows are submitted on their own
+                        self.submit_workflow_records(wf_id, json_records)
+                        continue
+                    if batch_size + len(json_records) > self._SUBMIT_CHUNK_SIZE:
+                        self.submit_batched_records(batch)
+                        batch, batch_size = [], 0
+                    batch.append((wf_id, json_records))
+                    batch_size += len(json_records)
+        if batch:
+            self.submit_batched_records(batch)
+
+    def prepare_sweep(self, pending):
+        """Hook run once before the pending workflows are processed, e.g. to look up their data objects in bulk
 
-        # Get list of all workflow records
-        mp_wf_recs = self.get_workflow_records()
+        Parameters
+        ----------
+        pending : list of dict
+            Workflow execution records that will be processed
 
-        # Iterate through all of the workflow records
-        for mp_wf_rec in mp_wf_recs:
-            if mp_wf_rec["id"] in mp_wf_in_agg:
-                continue
-            try:
-                functional_agg_dict = self.process_activity(mp_wf_rec)
-            except Exception as ex:
-                # Log the error and continue to the next record
-                logger.error(f"Error processing activity {mp_wf_rec['id']}: {ex}")
-                continue
-
-            # Prepare a  json record for the database
-            json_records = []
-            for k, v in functional_agg_dict.items():
-                json_records.append(
-                    {
-                        "was_generated_by": mp_wf_rec["id"],
-                        "gene_function_id": k,
-                        "count": v,
-                        "type": "nmdc:FunctionalAnnotationAggMember",
-                    }
-                )
-            json_record_full = {"functional_annotation_agg": json_records}
+        Returns
+        -------
+        None
+        """
+        return None
 
-            response = self.submit_json_records(json_record_full)
-            if response != 200:
-                logger.error(
-                    f"Error submitting the aggregation records for the workflow: {mp_wf_rec['id']}, Response code: {response}"
-                )
-            if response == 200:
-                print(
-                    "Submitted aggregation records for the workflow: ", mp_wf_rec["id"]
-                )
+    def _process(self, mp_wf_rec):
+        """Function to process a single workflow record into its aggregation records
+
+        Errors are logged rather than raised so that one bad workflow does not stop the sweep.
+
+        Parameters
+        ----------
+        mp_wf_rec : dict
+            Workflow execution record to process
+
+        Returns
+        -------
+        list of dict or None
+            Aggregation records of the workflow, or None if it could not be processed
+        """
+        try:
+            functional_agg_dict = self.process_activity(mp_wf_rec)
+        except Exception as ex:
+            # Log the error and continue to the next record
+            logger.error(f"Error processing activity {mp_wf_rec['id']}: {ex}")
+            return None
+
+        # Prepare a  json record for the database
+        return [
+            {
+                "was_generated_by": mp_wf_rec["id"],
+                "gene_function_id": k,
+                "count": v,
+                "type": "nmdc:FunctionalAnnotationAggMember",
+            }
+            for k, v in functional_agg_dict.items()
+        ]
+
+    def submit_workflow_records(self, wf_id, json_records):
+        """Function to submit the aggregation records of a single workflow
+
+        Parameters
+        ----------
+        wf_id : str
+            ID of the workflow execution the records were generated by
+        json_records : list of dict
+            Aggregation records of the workflow
+
+        Returns
+        -------
+        bool
+            True if the records were submitted, False otherwise
+
+        Notes
+        -----
+        A workflow is never split across requests. Any record of a workflow marks it as aggregated
+        for later sweeps, so a failure after part of its records were accepted could not be retried.
+        """
+        json_record_full = {"functional_annotation_agg": json_records}
+        response = self.submit_json_records(json_record_full)
+        if response != 200:
+            logger.error(
+                f"Error submitting the aggregation records for the workflow: {wf_id}, Response code: {response}"
+            )
+            return False
+        print("Submitted aggregation records for the workflow: ", wf_id)
+        self.write_checkpoint([wf_id])
+        return True
+
+    def submit_batched_records(self, batch):
+        """Function to submit the aggregation records of several workflows in one request
+
+        If the combined request fails, each workflow is submitted on its own so that
+        only the workflows with bad records are left out.
+
+        Parameters
+        ----------
+        batch : list of tuple
+            (workflow ID, aggregation records) of each workflow in the batch
+
+        Returns
+        -------
+        None
+        """
+        json_record_full = {
+            "functional_annotation_agg": [rec for _, json_records in batch for rec in json_records]
+        }
+        response = self.submit_json_records(json_record_full)
+        if response != 200:
+            logger.error(
+                f"Error submitting the aggregation records for {len(batch)} workflows, Response code: {response}, "
+                "submitting them one workflow at a time"
+            )
+            for wf_id, json_records in batch:
+                self.submit_workflow_records(wf_id, json_records)
+            return
+        for wf_id, _ in batch:
+            print("Submitted aggregation records for the workflow: ", wf_id)
+        self.write_checkpoint([wf_id for wf_id, _ in batch])
+
+    def read_checkpoint(self):
+        """Function to read the workflow ids recorded as submitted by earlier runs
+
+        Returns
+        -------
+        set
+            Set of workflow ids in the checkpoint file, empty if checkpointing is disabled or nothing was recorded yet
+        """
+        if not self.checkpoint_file:
+            return set()
+        try:
+            with open(self.checkpoint_file) as f:
+                return {json.loads(line)["id"] for line in f if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def write_checkpoint(self, wf_ids):
+        """Function to record workflow ids as submitted in the checkpoint file
+
+        Parameters
+        ----------
+        wf_ids : list of str
+            Workflow ids whose aggregation records were all submitted
+
+        Returns
+        -------
+        None
+        """
+        if not self.checkpoint_file:
+            return
+        try:
+            with open(self.checkpoint_file, "a") as f:
+                f.writelines(json.dumps({"id": wf_id}) + "\n" for wf_id in wf_ids)
+        except OSError as ex:
+            logger.error(f"Error writing the checkpoint file {self.checkpoint_file}: {ex}")
 
     def sweep_success(self):
         """Function to check the results of the sweep and ensure that the records were added to the database
@@ -272,19 +604,62 @@ class Aggregator(ABC):
         -------
         bool
             True if all records were added to the functional_annotation_agg collection, False otherwise
-        """
-        # Get list of workflow IDs that have already been processed
-        mp_wf_in_agg = self.get_previously_aggregated_workflow_ids()
 
-        # Get list of all workflow records
-        mp_wf_recs = self.get_workflow_records()
+        Notes
+        -----
+        After a sweep, only the workflows that were not aggregated when it started are looked up,
+        one small query each, instead of reading the ids of the whole aggregation collection again.
+        """
+        if self._aggregated_ids is not None:
+            unchecked = [
+                x["id"] for x in self.get_workflow_records() if x["id"] not in self._aggregated_ids
+            ]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return all(executor.map(self.is_aggregated, unchecked))
+
+        # The two queries are independent, so run them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # Get list of workflow IDs that have already been processed (always read fresh from the API)
+            agg_future = executor.submit(self.get_previously_aggregated_workflow_ids)
+
+            # Get list of all workflow records
+            wf_future = executor.submit(self.get_workflow_records)
+        mp_wf_in_agg = agg_future.result()
+        mp_wf_recs = wf_future.result()
 
         # If there are any records that were not processed, return FALSE
-        check = [x["id"] in mp_wf_in_agg for x in mp_wf_recs]
-        if all(check):
-            return True
-        else:
-            return False
+        return all(x["id"] in mp_wf_in_agg for x in mp_wf_recs)
+
+    def is_aggregated(self, wf_id):
+        """Function to check whether the functional_annotation_agg collection has records for a workflow
+
+        Parameters
+        ----------
+        wf_id : str
+            Workflow execution ID
+
+        Returns
+        -------
+        bool
+            True if at least one aggregation record was generated by the workflow, False otherwise
+
+        Notes
+        -----
+        Raises requests.HTTPError if the API returns an error, so that sweep_success does not
+        report a transient failure as a missing workflow.
+        """
+        # A single record answers the question, so only the first page is requested
+        resp = self.session.get(
+            f"{self.base_url}/nmdcschema/functional_annotation_agg",
+            params={
+                "filter": json.dumps({"was_generated_by": wf_id}, separators=(",", ":")),
+                "max_page_size": 1,
+                "projection": "was_generated_by",
+            },
+        )
+        # An API error must not be mistaken for a workflow without records
+        resp.raise_for_status()
+        return bool(resp.json().get("resources"))
 
     @abstractmethod
     def process_activity(self, act):
@@ -319,11 +694,117 @@ class MetaProtAgg(Aggregator):
     This class is used to aggregate functional annotations from metaproteomics workflows in the NMDC database.
     """
 
+    # Protein Report column -> function turning one of its terms into a gene_function_id
+    _TERM_PREFIXES = {
+        "KO": lambda term: term.replace("KO:", "KEGG.ORTHOLOGY:"),
+        "COG": lambda term: "COG:" + term,
+        "pfam": lambda term: "PFAM:" + term,
+    }
+
+    # Set the maximum number of data object IDs looked up in a single request
+    _DATA_OBJECT_CHUNK_SIZE = 100
+
+    # Set the maximum number of Protein Reports whose terms are kept in memory
+    _REPORT_TERMS_CACHE_SIZE = 128
+
     def __init__(self):
         super().__init__()
         self.aggregation_filter = '{"was_generated_by":{"$regex":"^nmdc:wfmp"}}'
         self.workflow_filter = '{"type":"nmdc:MetaproteomicsAnalysis"}'
 
+        # Data object ID -> Protein Report URL, filled in by load_protein_report_urls, and the
+        # data object IDs whose lookup failed there (find_protein_report_url queries those itself)
+        self.protein_report_urls = None
+        self.protein_report_failed_ids = set()
+
+        # Directory where parsed Protein Reports are kept between runs (disabled when unset)
+        self.report_cache_dir = os.getenv("NMDC_REPORT_CACHE_DIR")
+
+        # Functional terms of recently read Protein Reports keyed by URL, see invalidate_cache
+        self._report_terms = {}
+        self._report_terms_lock = threading.Lock()
+
+    def invalidate_cache(self):
+        """Function to drop all results cached by get_results and all Protein Report terms kept in memory
+
+        Returns
+        -------
+        None
+        """
+        super().invalidate_cache()
+        with self._report_terms_lock:
+            self._report_terms.clear()
+
+    def prepare_sweep(self, pending):
+        """Function to look up the Protein Report URLs of all pending workflows before they are processed
+
+        Parameters
+        ----------
+        pending : list of dict
+            Workflow execution records that will be processed
+
+        Returns
+        -------
+        None
+        """
+        self.load_protein_report_urls(pending)
+
+    def load_protein_report_urls(self, workflow_records):
+        """Function to look up the Protein Report URLs of many workflows with a few batched requests
+
+        Parameters
+        ----------
+        workflow_records : list of dict
+            Workflow execution records whose has_output data objects are looked up
+
+        Returns
+        -------
+        None, but sets the protein_report_urls and protein_report_failed_ids attributes used by
+        find_protein_report_url
+
+        Notes
+        -----
+        A failed request is logged rather than raised, so it does not stop the sweep. The workflows
+        whose data objects it covered fall back to a lookup of their own in find_protein_report_url.
+        """
+        do_ids = list(
+            dict.fromkeys(doid for rec in workflow_records for doid in rec.get("has_output", []))
+        )
+        chunks = [
+            do_ids[i : i + self._DATA_OBJECT_CHUNK_SIZE]
+            for i in range(0, len(do_ids), self._DATA_OBJECT_CHUNK_SIZE)
+        ]
+
+        def get_protein_reports(chunk):
+            do_filter = json.dumps(
+                {"id": {"$in": chunk}, "data_object_type": "Protein Report"}, separators=(",", ":")
+            )
+            try:
+                return list(
+                    self._iter_results(
+                        collection="data_object_set",
+                        filter=do_filter,
+                        max_page_size=self._DATA_OBJECT_CHUNK_SIZE,
+                        fields="id,url",
+                    )
+                )
+            except Exception as ex:
+                # Log the error, the workflows of this chunk are looked up one at a time instead
+                logger.error(f"Error looking up the Protein Reports of {len(chunk)} data objects: {ex}")
+                return None
+
+        # The chunks are independent, so request them concurrently
+        urls = {}
+        failed_ids = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for chunk, do_recs in zip(chunks, executor.map(get_protein_reports, chunks)):
+                if do_recs is None:
+                    failed_ids.update(chunk)
+                else:
+                    urls.update((do["id"], do.get("url")) for do in do_recs)
+        self.protein_report_urls = urls
+        self.protein_report_failed_ids = failed_ids
+
     def get_functional_terms_from_protein_report(self, url):
         """Function to get the functional terms from a URL of a Protein Report
 
@@ -336,57 +817,114 @@ class MetaProtAgg(Aggregator):
         -------
         dict
             Dictionary of KEGG, COG, and PFAM terms with their respective spectral counts derived from the Protein Report
+
+        Notes
+        -----
+        When NMDC_REPORT_CACHE_DIR is set, the terms are cached there by URL and reused for as long as
+        the report's ETag is unchanged, so a workflow retried by a later sweep is not downloaded again.
+        Within a run, the terms of the most recently read reports are also kept in memory, so workflows
+        sharing a Protein Report only read it once.
         """
-        fxns = {}
-
-        content = self.read_url_tsv(url)
-
-        # Parse the Protein Report content into KO, COG, and Pfam terms
-        for line in content:
-            # Add ko terms to the dictionary
-            ko = line.get("KO")
-            if ko != "" and ko is not None:
-                # Replace KO: with KEGG.ORTHOLOGY:
-                ko_clean = ko.replace("KO:", "KEGG.ORTHOLOGY:")
-                if ko_clean not in fxns.keys():
-                    fxns[ko_clean] = int(line.get("SummedSpectraCounts"))
-                else:
-                    fxns[ko_clean] += int(line.get("SummedSpectraCounts"))
-
-            # Add cog terms to the dictionary
-            cog = line.get("COG")
-            if cog != "" and cog is not None:
-                cog_clean = "COG:" + cog
-                if cog_clean not in fxns.keys():
-                    fxns[cog_clean] = int(line.get("SummedSpectraCounts"))
-                else:
-                    fxns[cog_clean] += int(line.get("SummedSpectraCounts"))
-
-            # Add pfam terms to the dictionary
-            pfam = line.get("pfam")
-            if pfam != "" and pfam is not None:
-                pfam_clean = "PFAM:" + pfam
-                if pfam_clean not in fxns.keys():
-                    fxns[pfam_clean] = int(line.get("SummedSpectraCounts"))
-                else:
-                    fxns[pfam_clean] += int(line.get("SummedSpectraCounts"))
-
-        # For all, loop through keys and separate into multiple keys if there are multiple pfams
-        new_fxns = {}
-        for k, v in fxns.items():
-            if "," in k:
-                for pfam in k.split(","):
-                    # Check if pfam is already "PFAM:" prefixed
-                    if not pfam.startswith("PFAM:"):
-                        pfam = "PFAM:" + pfam
-                    if pfam not in new_fxns.keys():
-                        new_fxns[pfam] = v
-                    else:
-                        new_fxns[pfam] += v
-            else:
-                new_fxns[k] = v
-
-        return new_fxns
+        with self._report_terms_lock:
+            terms = self._report_terms.get(url)
+        if terms is not None:
+            return dict(terms)
+
+        etag = None
+        if self.report_cache_dir:
+            etag = self.session.head(url, allow_redirects=True).headers.get("ETag")
+            cached = self.read_report_cache(url, etag)
+            if cached is not None:
+                self._remember_report_terms(url, cached)
+                return dict(cached)
+
+        # Sum the spectral counts per distinct raw KO, COG and pfam value first, so each
+        # value is only cleaned and split once instead of once per protein
+        value_counts = Counter()
+        for line in self.read_url_tsv(url):
+            # Only read the count of rows with terms, rows without any may leave it empty
+            count = None
+            for column in self._TERM_PREFIXES:
+                value = line.get(column)
+                if value:
+                    if count is None:
+                        count = int(line.get("SummedSpectraCounts"))
+                    value_counts[column, value] += count
+
+        # Separate values with multiple terms and prefix each term by its column
+        fxns = Counter()
+        for (column, value), count in value_counts.items():
+            for term in value.split(","):
+                fxns[self._TERM_PREFIXES[column](term)] += count
+
+        if etag:
+            self.write_report_cache(url, etag, fxns)
+        self._remember_report_terms(url, dict(fxns))
+        return dict(fxns)
+
+    def _remember_report_terms(self, url, terms):
+        """Keep the functional terms of a Protein Report in memory, dropping the oldest report when full"""
+        with self._report_terms_lock:
+            if len(self._report_terms) >= self._REPORT_TERMS_CACHE_SIZE:
+                del self._report_terms[next(iter(self._report_terms))]
+            self._report_terms[url] = terms
+
+    def _report_cache_path(self, url):
+        """Path of the cache file for a Protein Report URL"""
+        return os.path.join(self.report_cache_dir, hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def read_report_cache(self, url, etag):
+        """Function to read the cached functional terms of a Protein Report
+
+        Parameters
+        ----------
+        url : str
+            URL to the Protein Report
+        etag : str or None
+            Current ETag of the Protein Report
+
+        Returns
+        -------
+        dict or None
+            Cached functional terms, or None if they are missing or were cached for another ETag
+        """
+        if not etag:
+            return None
+        try:
+            with open(self._report_cache_path(url)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get("url") != url or cached.get("etag") != etag:
+            return None
+        return cached["terms"]
+
+    def write_report_cache(self, url, etag, terms):
+        """Function to cache the functional terms of a Protein Report
+
+        Parameters
+        ----------
+        url : str
+            URL to the Protein Report
+        etag : str
+            ETag of the Protein Report the terms were read from
+        terms : dict
+            Functional terms with their respective spectral counts
+
+        Returns
+        -------
+        None
+        """
+        path = self._report_cache_path(url)
+        try:
+            os.makedirs(self.report_cache_dir, exist_ok=True)
+            # Write to a temporary file first so a reader never sees a partial entry
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"url": url, "etag": etag, "terms": terms}, f)
+            os.replace(tmp_path, path)
+        except OSError as ex:
+            logger.error(f"Error caching the Protein Report {url}: {ex}")
 
     def find_protein_report_url(self, dos):
         """Find the URL for the protein report from a list of data object IDs
@@ -403,20 +941,28 @@ class MetaProtAgg(Aggregator):
         """
         url = None
 
-        # Get all the data object records
-        id_filter = '{"id": {"$in": ["' + '","'.join(dos) + '"]}}'
-        do_recs = self.get_results(
+        # Use the URLs looked up for the whole sweep when they are available
+        if self.protein_report_urls is not None and self.protein_report_failed_ids.isdisjoint(dos):
+            return next(
+                (self.protein_report_urls[doid] for doid in dos if doid in self.protein_report_urls),
+                None,
+            )
+
+        # Let the API only return the Protein Report (specific to this workflow, so not cached)
+        id_filter = json.dumps(
+            {"id": {"$in": list(dos)}, "data_object_type": "Protein Report"}, separators=(",", ":")
+        )
+        do_recs = self._iter_results(
             collection="data_object_set",
             filter=id_filter,
-            max_page_size=1000,
-            fields="id,data_object_type,url",
+            max_page_size=10,
+            fields="id,url",
         )
 
-        # Find the Protein Report data object and return the URL to access it
+        # Return the URL of the first Protein Report, which stops the paging
         for do in do_recs:
-            if do.get("data_object_type") == "Protein Report":
-                url = do.get("url")
-                return url
+            url = do.get("url")
+            return url
 
         # If no Protein Report data object is found, return None
         return None
@@ -0,0 +1,52 @@
+import hashlib
+import os
+
+import pytest
+import requests
+
+from generate_functional_agg import MetaGenomeFuncAgg
+
+GFF_URL = "https://portal.nersc.gov/cfs/m3408/test_data/metaT/functional_annotation.gff"
+
+
+@pytest.fixture(scope="session")
+def cached_download(request):
+    """Returns a function that downloads a URL once and gives the path of the local copy
+
+    Copies are kept in the pytest cache directory (.pytest_cache), so later test
+    runs read the file from disk instead of fetching it again. Tests that need a
+    file that is not cached are skipped when there is no network.
+    """
+    cache_dir = request.config.cache.mkdir("downloads")
+
+    def download(url):
+        # Keep the file name so the copy can stand in for the URL under a base path
+        path = cache_dir / hashlib.sha1(os.path.dirname(url).encode()).hexdigest() / os.path.basename(url)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_name(path.name + ".tmp")
+            try:
+                with requests.get(url, stream=True, timeout=60) as resp:
+                    resp.raise_for_status()
+                    with open(tmp_path, "wb") as f:
+                        for chunk in resp.iter_content(chunk_size=1 << 16):
+                            f.write(chunk)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                # the checked-in fixtures under tests/data cover the same code offline
+                pytest.skip(f"{url} is not cached and cannot be downloaded: {ex}")
+            os.replace(tmp_path, path)
+        return path
+
+    return download
+
+
+@pytest.fixture(scope="session")
+def metag_terms(cached_download):
+    """Functional annotation counts of the test GFF, parsed once per test session"""
+    # Read the local copy of the GFF through the base path mapping
+    path = cached_download(GFF_URL)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("MONGO_URL", "mongodb://db")
+        mp.setenv("NMDC_BASE_URL", os.path.dirname(GFF_URL))
+        mp.setenv("NMDC_BASE_PATH", str(path.parent))
+        return MetaGenomeFuncAgg().get_functional_annotation_counts(GFF_URL)
@@ -1,10 +1,23 @@
+import gzip
+import io
+import os
+import pytest
+import requests
+import threading
+import time
+import types
+from urllib3.response import HTTPResponse
+
 from generate_functional_agg import AnnotationLine
 from generate_functional_agg import MetaGenomeFuncAgg
+from generate_functional_agg import get_functional_terms
+from generate_functional_agg import prefetch_lines
+
+LINE = "nmdc:wfmtan-11-5rqhd817.1_0000001	Prodigal v2.6.3_patched	CDS	2931	5588	340.0	+	0	ID=nmdc:wfmgan-11-5rqhd817.1_0000001_2931_5588;translation_table=11;start_type=ATG;product=O-antigen biosynthesis protein;product_source=KO:K20444;cath_funfam=3.20.20.80,3.90.550.10;cog=COG0463;ko=KO:K20444;ec_number=EC:2.4.1.-;pfam=PF00535,PF02836;superfamily=51445,53448"
 
 
 def test_AnnotationLine():
-    line = "nmdc:wfmtan-11-5rqhd817.1_0000001	Prodigal v2.6.3_patched	CDS	2931	5588	340.0	+	0	ID=nmdc:wfmgan-11-5rqhd817.1_0000001_2931_5588;translation_table=11;start_type=ATG;product=O-antigen biosynthesis protein;product_source=KO:K20444;cath_funfam=3.20.20.80,3.90.550.10;cog=COG0463;ko=KO:K20444;ec_number=EC:2.4.1.-;pfam=PF00535,PF02836;superfamily=51445,53448"
-    anno = AnnotationLine(line)
+    anno = AnnotationLine(LINE)
     assert anno
     assert len(anno.kegg) > 0
     assert anno.id == "nmdc:wfmgan-11-5rqhd817.1_0000001_2931_5588"
@@ -12,13 +25,240 @@ def test_AnnotationLine():
     assert anno.kegg == ["KEGG.ORTHOLOGY:K20444"]
     assert anno.pfams == ["PFAM:PF00535", "PFAM:PF02836"]
 
+    # lines outside the filter keep their ID but skip the attribute scan
+    skipped = AnnotationLine(LINE, filter=frozenset(["nmdc:other"]))
+    assert skipped.id == anno.id
+    assert skipped.kegg is None
+    assert AnnotationLine(LINE, filter=frozenset([anno.id])).kegg == anno.kegg
+
+
+def test_get_functional_terms():
+    assert get_functional_terms(LINE.encode()) == [
+        b"KEGG.ORTHOLOGY:K20444", b"COG:COG0463", b"PFAM:PF00535", b"PFAM:PF02836"
+    ]
+    assert get_functional_terms(LINE.replace("ko=KO:K20444;", "").encode()) == []
+
+
+def test_prefetch_lines():
+    lines = [f"line {i}".encode() for i in range(25)]
+    assert list(prefetch_lines(lines, batch_size=10, max_batches=1)) == lines
+
+    def broken():
+        yield b"first"
+        raise OSError("connection reset")
+
+    with pytest.raises(OSError):
+        list(prefetch_lines(broken()))
 
-def test_functional_annotation_counts(monkeypatch):
+    # a consumer that stops early releases the reader, which closes its source
+    source = io.BytesIO(b"line\n" * 100000)
+    before = threading.active_count()
+    lines = prefetch_lines(source, batch_size=10, max_batches=1)
+    assert next(lines) == b"line\n"
+    lines.close()
+    for _ in range(50):
+        if source.closed and threading.active_count() <= before:
+            break
+        time.sleep(0.1)
+    assert source.closed
+    assert threading.active_count() <= before
+
+
+def test_functional_annotation_counts_from_fixture(monkeypatch):
+    # a trimmed GFF checked in under tests/data, read through the base path mapping
     monkeypatch.setenv("MONGO_URL", "mongodb://db")
+    monkeypatch.setenv("NMDC_BASE_URL", "https://example.org/data")
+    monkeypatch.setenv("NMDC_BASE_PATH", os.path.join(os.path.dirname(__file__), "data"))
     mp = MetaGenomeFuncAgg()
-    url = "https://portal.nersc.gov/cfs/m3408/test_data/metaT/functional_annotation.gff"
-    terms = mp.get_functional_annotation_counts(url)
+    terms = mp.get_functional_annotation_counts("https://example.org/data/functional_annotation.gff")
+    assert len(terms) == 24
+    assert terms["KEGG.ORTHOLOGY:K00031"] == 1
+    assert terms["KEGG.ORTHOLOGY:K03320"] == 3
+    assert terms["KEGG.ORTHOLOGY:K07637"] == 1
+    assert terms["COG:COG0004"] == 3
+    assert terms["COG:COG2205"] == 1
+    assert terms["PFAM:PF00206"] == 2
+    assert terms["PFAM:PF02518"] == 1
+    # lines without a KO are not counted
+    assert "COG:COG1131" not in terms
+    assert "PFAM:PF00005" not in terms
+
+
+def test_functional_annotation_counts(metag_terms):
+    terms = metag_terms
     assert len(terms) == 1965
     assert terms["KEGG.ORTHOLOGY:K00031"] == 1
     assert terms["COG:COG0004"] == 3
     assert terms["PFAM:PF00206"] == 2
+
+
+class FakeCursor(list):
+
+    def batch_size(self, n):
+        return self
+
+
+class FakeCollection():
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find(self, q, projection=None):
+        self.queries.append(q)
+        return FakeCursor(
+            {k: v for k, v in doc.items() if k in ("id", "url")}
+            for doc in self.docs
+            if ("id" not in q or doc["id"] in q["id"]["$in"])
+            and doc.get("data_object_type") == q["data_object_type"]
+        )
+
+
+def test_find_anno(monkeypatch):
+    monkeypatch.setenv("MONGO_URL", "mongodb://db")
+    mp = MetaGenomeFuncAgg()
+    mp.do_col = FakeCollection([
+        {"id": "nmdc:dobj-1", "data_object_type": "Annotation Amino Acid FASTA", "url": "faa"},
+        {"id": "nmdc:dobj-2", "data_object_type": "Functional Annotation GFF", "url": "gff"},
+        {"id": "nmdc:dobj-3"},
+    ])
+    assert mp.find_anno(["nmdc:dobj-1", "nmdc:dobj-2", "nmdc:dobj-3"]) == "gff"
+    assert mp.find_anno(["nmdc:dobj-1", "nmdc:dobj-3"]) is None
+    assert len(mp.do_col.queries) == 2
+
+    # once the URLs of the pending executions are loaded up front, find_anno stops querying
+    monkeypatch.setattr(mp, "_DATA_OBJECT_CHUNK_SIZE", 2)
+    mp.load_gff_urls([
+        {"id": "nmdc:wfmgan-1", "has_output": ["nmdc:dobj-1", "nmdc:dobj-2"]},
+        {"id": "nmdc:wfmgan-2", "has_output": ["nmdc:dobj-2", "nmdc:dobj-3"]},
+    ])
+    # only the outputs of those executions are queried, a chunk at a time
+    assert [q["id"]["$in"] for q in mp.do_col.queries[2:]] == [["nmdc:dobj-1", "nmdc:dobj-2"], ["nmdc:dobj-3"]]
+    assert mp.find_anno(["nmdc:dobj-1", "nmdc:dobj-2", "nmdc:dobj-3"]) == "gff"
+    assert mp.find_anno(["nmdc:dobj-1", "nmdc:dobj-3"]) is None
+    assert len(mp.do_col.queries) == 4
+
+
+class FakeAggCollection():
+
+    def __init__(self, done):
+        self.done = done
+        self.inserts = []
+
+    def aggregate(self, pipeline, **kwargs):
+        return [{"_id": wid} for wid in self.done]
+
+    def insert_many(self, rows, ordered=True):
+        self.inserts.append(rows)
+
+
+class FakeExecutionCollection():
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find(self, q, projection=None):
+        self.queries.append(q)
+        return FakeCursor(doc for doc in self.docs if "id" not in q or doc["id"] not in q["id"]["$nin"])
+
+
+@pytest.mark.parametrize("max_nin_ids", [10, 0])
+def test_sweep_batches_inserts(monkeypatch, max_nin_ids):
+    monkeypatch.setenv("MONGO_URL", "mongodb://db")
+    mp = MetaGenomeFuncAgg()
+    monkeypatch.setattr(mp, "_INSERT_BATCH_SIZE", 4)
+    monkeypatch.setattr(mp, "_MAX_NIN_IDS", max_nin_ids)
+    mp.agg_col = FakeAggCollection(["nmdc:wfmgan-0"])
+    mp.do_col = FakeCollection([])
+    executions = FakeExecutionCollection([{"id": f"nmdc:wfmgan-{i}", "has_output": []} for i in range(6)])
+    mp.db = types.SimpleNamespace(workflow_execution_set=executions)
+    monkeypatch.setattr(mp, "process_workflow_execution", lambda rec: [
+        {"was_generated_by": rec["id"], "gene_function_id": f"COG:COG000{i}", "count": 1} for i in range(2)
+    ])
+
+    mp.sweep()
+    # too many aggregated ids are skipped locally instead of being sent in the query
+    if max_nin_ids:
+        assert executions.queries[0]["id"] == {"$nin": ["nmdc:wfmgan-0"]}
+    else:
+        assert "id" not in executions.queries[0]
+    # two executions fill a batch, the remainder is flushed at the end
+    assert [len(rows) for rows in mp.agg_col.inserts] == [4, 4, 2]
+
+
+def test_sweep_bounds_executions_in_flight(monkeypatch):
+    monkeypatch.setenv("MONGO_URL", "mongodb://db")
+    mp = MetaGenomeFuncAgg()
+    mp.workers = 1
+    monkeypatch.setattr(mp, "_IN_FLIGHT_PER_WORKER", 1)
+    monkeypatch.setattr(mp, "_INSERT_BATCH_SIZE", 1)
+    mp.agg_col = FakeAggCollection([])
+    mp.do_col = FakeCollection([])
+    executions = FakeExecutionCollection([{"id": f"nmdc:wfmgan-{i}", "has_output": []} for i in range(20)])
+    mp.db = types.SimpleNamespace(workflow_execution_set=executions)
+    processed = []
+    monkeypatch.setattr(mp, "process_workflow_execution", lambda rec: processed.append(rec["id"]) or [
+        {"was_generated_by": rec["id"], "gene_function_id": "COG:COG0001", "count": 1}
+    ])
+    in_flight = []
+
+    def insert_rows(rows):
+        # executions processed but not inserted yet: the one being inserted and the next queued one
+        in_flight.append(len(processed) - len(in_flight))
+
+    monkeypatch.setattr(mp, "insert_rows", insert_rows)
+
+    mp.sweep()
+    assert len(in_flight) == 20
+    assert max(in_flight) <= 2
+
+
+@pytest.mark.parametrize("encoding", [None, "gzip"])
+def test_open_response(monkeypatch, encoding):
+    monkeypatch.setenv("MONGO_URL", "mongodb://db")
+    mp = MetaGenomeFuncAgg()
+    body = (LINE + "\n").encode() * 3
+    resp = requests.Response()
+    resp.headers["Content-Encoding"] = encoding or "identity"
+    resp.raw = HTTPResponse(
+        body=io.BytesIO(gzip.compress(body) if encoding else body),
+        headers=resp.headers,
+        preload_content=False,
+    )
+    assert b"".join(mp.open_response(resp)) == body
+
+
+class FakeRangeSession():
+    """Serves a byte string with HEAD and open-ended Range requests"""
+
+    def __init__(self, body):
+        self.body = body
+
+    def head(self, url, **kwargs):
+        return types.SimpleNamespace(ok=True, headers={"Content-Length": str(len(self.body)), "Accept-Ranges": "bytes"})
+
+    def get(self, url, headers=None, **kwargs):
+        offset = int(headers["Range"][len("bytes="):-1])
+        raw = io.BytesIO(self.body[offset:])
+        return types.SimpleNamespace(status_code=206, headers={}, raw=raw, close=raw.close)
+
+
+@pytest.mark.parametrize("parts", [1, 3, 7])
+def test_functional_annotation_counts_by_range(monkeypatch, parts):
+    monkeypatch.setenv("MONGO_URL", "mongodb://db")
+    mp = MetaGenomeFuncAgg()
+    monkeypatch.setattr(mp, "_RANGE_MIN_SIZE", 1)
+    # every worker can have all of its range reads open at once without overflowing the pool
+    assert mp.session.get_adapter("https://example.org")._pool_maxsize == mp.workers * mp._RANGE_PARTS
+    monkeypatch.setattr(mp, "_RANGE_PARTS", parts)
+    lines = [LINE, LINE.replace("ko=KO:K20444;", ""), LINE.replace("K20444", "K00001")]
+    mp.session = FakeRangeSession(("\n".join(lines * 3) + "\n").encode())
+
+    assert mp.get_functional_annotation_counts("https://example.org/x.gff") == {
+        "KEGG.ORTHOLOGY:K20444": 3,
+        "KEGG.ORTHOLOGY:K00001": 3,
+        "COG:COG0463": 6,
+        "PFAM:PF00535": 6,
+        "PFAM:PF02836": 6,
+    }
@@ -0,0 +1,413 @@
+import base64
+import io
+import json
+import time
+
+import pytest
+import requests
+from urllib3.response import HTTPResponse
+
+from generate_metap_agg import Aggregator
+from generate_metap_agg import MetaProtAgg
+
+
+class FakeResponse():
+
+    def __init__(self, data, status_code=200, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error")
+
+
+class FakeSession():
+    """Stands in for requests.Session, returning the canned responses in order"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        return self.responses.pop(0)
+
+    post = get
+    head = get
+
+
+def make_agg(responses=()):
+    mp = MetaProtAgg()
+    mp.session = FakeSession(responses)
+    return mp
+
+
+def make_token(exp):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+def test_session_pool_follows_worker_count(monkeypatch):
+    monkeypatch.setenv("NMDC_AGG_WORKERS", "24")
+    mp = MetaProtAgg()
+    assert mp.session.get_adapter("https://api.microbiomedata.org")._pool_maxsize == 48
+
+
+def test_get_results_follows_page_tokens():
+    mp = make_agg([
+        FakeResponse({"resources": [{"id": "a"}, {"id": "b"}], "next_page_token": "t1"}),
+        FakeResponse({"resources": [{"id": "c"}], "next_page_token": None}),
+    ])
+    results = mp.get_results("workflow_execution_set", max_page_size=2)
+    assert [r["id"] for r in results] == ["a", "b", "c"]
+    assert len(mp.session.calls) == 2
+    assert mp.session.calls[0][1]["params"] == {"max_page_size": 2}
+    assert mp.session.calls[1][1]["params"]["page_token"] == "t1"
+
+    # the same query is served from the cache until it is invalidated
+    assert mp.get_results("workflow_execution_set", max_page_size=2) == results
+    assert len(mp.session.calls) == 2
+    mp.invalidate_cache()
+    mp.session.responses.append(FakeResponse({"resources": []}))
+    assert mp.get_results("workflow_execution_set", max_page_size=2) == []
+
+
+def test_get_previously_aggregated_workflow_ids():
+    mp = make_agg([
+        FakeResponse({"resources": [
+            {"was_generated_by": "nmdc:wfmp-1"},
+            {"was_generated_by": "nmdc:wfmp-1"},
+            {"was_generated_by": "nmdc:wfmp-2"},
+        ]}),
+    ])
+    assert mp.get_previously_aggregated_workflow_ids() == {"nmdc:wfmp-1", "nmdc:wfmp-2"}
+
+
+def test_get_workflow_records():
+    mp = make_agg([FakeResponse({"resources": [{"id": "nmdc:wfmp-1"}, {"id": "nmdc:wfmp-3"}]})])
+    assert mp.get_workflow_records() == [{"id": "nmdc:wfmp-1"}, {"id": "nmdc:wfmp-3"}]
+    assert json.loads(mp.session.calls[0][1]["params"]["filter"]) == {"type": "nmdc:MetaproteomicsAnalysis"}
+    assert mp.session.calls[0][1]["params"]["projection"] == "id,has_output"
+
+
+def test_bearer_token_is_fetched_lazily_and_refreshed_on_401():
+    old_token = make_token(time.time() + 3600)
+    new_token = make_token(time.time() + 7200)
+    mp = make_agg([
+        FakeResponse({"access_token": old_token}),
+        FakeResponse({}, status_code=401),
+        FakeResponse({"access_token": new_token}),
+        FakeResponse({}, status_code=200),
+    ])
+    assert mp.session.calls == []
+
+    assert mp.submit_json_records({"functional_annotation_agg": []}) == 200
+    assert mp.session.calls[-1][1]["headers"]["Authorization"] == f"Bearer {new_token}"
+    assert mp.get_token_expiry(new_token) > time.time() + 3600
+    assert mp.get_token_expiry("not-a-jwt") == float("inf")
+
+
+def test_401_does_not_refresh_a_token_already_replaced():
+    old_token = make_token(time.time() + 3600)
+    new_token = make_token(time.time() + 7200)
+    mp = make_agg()
+    mp._nmdc_api_token = old_token
+    mp._token_expiry = mp.get_token_expiry(old_token)
+
+    def post(url, **kwargs):
+        mp.session.calls.append((url, kwargs))
+        if len(mp.session.calls) == 1:
+            # another thread refreshes the token while this request is rejected
+            mp._nmdc_api_token = new_token
+            return FakeResponse({}, status_code=401)
+        return FakeResponse({}, status_code=200)
+
+    mp.session.post = post
+    assert mp.submit_json_records({"functional_annotation_agg": []}) == 200
+    assert not any(url.endswith("/token") for url, _ in mp.session.calls)
+    assert mp.session.calls[-1][1]["headers"]["Authorization"] == f"Bearer {new_token}"
+
+
+@pytest.mark.parametrize("batch_status", [200, 500])
+def test_sweep_batches_submissions(monkeypatch, batch_status):
+    mp = make_agg()
+    monkeypatch.setattr(mp, "_SUBMIT_CHUNK_SIZE", 4)
+    monkeypatch.setattr(mp, "get_previously_aggregated_workflow_ids", lambda: {"nmdc:wfmp-0"})
+    monkeypatch.setattr(mp, "get_workflow_records", lambda: [
+        {"id": f"nmdc:wfmp-{i}", "has_output": []} for i in range(4)
+    ])
+    monkeypatch.setattr(mp, "load_protein_report_urls", lambda pending: None)
+    sizes = {"nmdc:wfmp-1": 2, "nmdc:wfmp-2": 2, "nmdc:wfmp-3": 5}
+    monkeypatch.setattr(mp, "process_activity", lambda rec: {f"COG:COG000{i}": i for i in range(sizes[rec["id"]])})
+    submitted = []
+
+    def submit_json_records(records):
+        records = records["functional_annotation_agg"]
+        submitted.append(records)
+        # a request combining several workflows can be rejected as a whole
+        return batch_status if len({r["was_generated_by"] for r in records}) > 1 else 200
+
+    monkeypatch.setattr(mp, "submit_json_records", submit_json_records)
+
+    mp.sweep()
+    # the two small workflows share a request, the large one is sent whole on its own
+    if batch_status == 200:
+        assert sorted(len(records) for records in submitted) == [4, 5]
+    else:
+        assert sorted(len(records) for records in submitted) == [2, 2, 4, 5]
+    assert {
+        "was_generated_by": "nmdc:wfmp-3",
+        "gene_function_id": "COG:COG0004",
+        "count": 4,
+        "type": "nmdc:FunctionalAnnotationAggMember",
+    } in [record for records in submitted for record in records]
+
+
+def test_sweep_checkpoints_submitted_workflows(monkeypatch, tmp_path):
+    monkeypatch.setenv("NMDC_AGG_CHECKPOINT", str(tmp_path / "done.jsonl"))
+    mp = make_agg()
+    monkeypatch.setattr(mp, "get_previously_aggregated_workflow_ids", lambda: set())
+    monkeypatch.setattr(mp, "get_workflow_records", lambda: [
+        {"id": f"nmdc:wfmp-{i}", "has_output": []} for i in range(3)
+    ])
+    monkeypatch.setattr(mp, "load_protein_report_urls", lambda pending: None)
+    monkeypatch.setattr(mp, "process_activity", lambda rec: {"COG:COG0001": 1})
+    submitted = []
+    monkeypatch.setattr(mp, "submit_json_records", lambda records: submitted.append(records) or 200)
+
+    assert mp.read_checkpoint() == set()
+    mp.sweep()
+    assert mp.read_checkpoint() == {"nmdc:wfmp-0", "nmdc:wfmp-1", "nmdc:wfmp-2"}
+
+    # a restarted sweep skips the checkpointed workflows even if the API does not list them yet
+    submitted.clear()
+    mp.sweep()
+    assert submitted == []
+
+
+def test_sweep_bounds_workflows_in_flight(monkeypatch):
+    mp = make_agg()
+    mp.max_workers = 1
+    monkeypatch.setattr(mp, "_IN_FLIGHT_PER_WORKER", 1)
+    monkeypatch.setattr(mp, "_SUBMIT_CHUNK_SIZE", 1)
+    monkeypatch.setattr(mp, "get_previously_aggregated_workflow_ids", lambda: set())
+    monkeypatch.setattr(mp, "get_workflow_records", lambda: [
+        {"id": f"nmdc:wfmp-{i}", "has_output": []} for i in range(20)
+    ])
+    monkeypatch.setattr(mp, "load_protein_report_urls", lambda pending: None)
+    processed = []
+    monkeypatch.setattr(mp, "process_activity", lambda rec: processed.append(rec["id"]) or {"COG:COG0001": 1})
+    in_flight = []
+
+    def submit_json_records(records):
+        # workflows processed but not submitted yet: the one being submitted and the next queued one
+        in_flight.append(len(processed) - len(in_flight))
+        return 200
+
+    monkeypatch.setattr(mp, "submit_json_records", submit_json_records)
+
+    mp.sweep()
+    assert len(in_flight) == 20
+    assert max(in_flight) <= 2
+
+
+def test_sweep_without_prepare_sweep_override(monkeypatch):
+    class BareAgg(Aggregator):
+        def process_activity(self, act):
+            return {"COG:COG0001": 1}
+
+    agg = BareAgg()
+    monkeypatch.setattr(agg, "get_previously_aggregated_workflow_ids", lambda: set())
+    monkeypatch.setattr(agg, "get_workflow_records", lambda: [{"id": "nmdc:wf-1"}])
+    submitted = []
+    monkeypatch.setattr(agg, "submit_json_records", lambda records: submitted.append(records) or 200)
+
+    agg.sweep()
+    assert [r["was_generated_by"] for r in submitted[0]["functional_annotation_agg"]] == ["nmdc:wf-1"]
+
+
+def test_get_functional_terms_from_protein_report(monkeypatch):
+    mp = make_agg()
+    rows = [
+        {"KO": "KO:K00031", "COG": "COG0538", "pfam": "PF00180,PF00181", "SummedSpectraCounts": "5"},
+        {"KO": "", "COG": "COG0538", "pfam": "PF00180", "SummedSpectraCounts": "2"},
+        {"KO": "KO:K00031", "COG": "", "pfam": "", "SummedSpectraCounts": "3"},
+        # values with several terms are split and prefixed by their own column
+        {"KO": "KO:K00031,KO:K00032", "COG": "COG0538,COG0539", "pfam": "", "SummedSpectraCounts": "1"},
+        # rows without terms are skipped before their count is read
+        {"KO": "", "COG": "", "pfam": "", "SummedSpectraCounts": ""},
+        {"KO": "", "COG": "", "pfam": ""},
+    ]
+    reads = []
+    monkeypatch.setattr(mp, "read_url_tsv", lambda url: reads.append(url) or rows)
+    terms = {
+        "KEGG.ORTHOLOGY:K00031": 9,
+        "KEGG.ORTHOLOGY:K00032": 1,
+        "COG:COG0538": 8,
+        "COG:COG0539": 1,
+        "PFAM:PF00180": 7,
+        "PFAM:PF00181": 5,
+    }
+    assert mp.get_functional_terms_from_protein_report("https://example.org/report.tsv") == terms
+
+    # a report shared by another workflow is not read again, and callers get their own copy
+    shared = mp.get_functional_terms_from_protein_report("https://example.org/report.tsv")
+    assert shared == terms
+    shared.clear()
+    assert mp.get_functional_terms_from_protein_report("https://example.org/report.tsv") == terms
+    assert len(reads) == 1
+
+
+def test_protein_report_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("NMDC_REPORT_CACHE_DIR", str(tmp_path / "reports"))
+    mp = make_agg([
+        FakeResponse({}, headers={"ETag": '"v1"'}),
+        FakeResponse({}, headers={"ETag": '"v1"'}),
+        FakeResponse({}, headers={"ETag": '"v2"'}),
+    ])
+    reads = []
+    monkeypatch.setattr(mp, "read_url_tsv", lambda url: reads.append(url) or [
+        {"KO": "KO:K00031", "COG": "", "pfam": "PF00180", "SummedSpectraCounts": "5"},
+    ])
+    terms = {"KEGG.ORTHOLOGY:K00031": 5, "PFAM:PF00180": 5}
+
+    assert mp.get_functional_terms_from_protein_report("https://example.org/report.tsv") == terms
+    # an unchanged ETag is served from the cache, a new one reads the report again
+    # (the terms kept in memory are dropped to stand in for a later run)
+    mp.invalidate_cache()
+    assert mp.get_functional_terms_from_protein_report("https://example.org/report.tsv") == terms
+    assert len(reads) == 1
+    mp.invalidate_cache()
+    assert mp.get_functional_terms_from_protein_report("https://example.org/report.tsv") == terms
+    assert len(reads) == 2
+
+
+def test_find_protein_report_url_stops_paging():
+    mp = make_agg([
+        FakeResponse({"resources": [{"id": "a", "data_object_type": "Protein Report", "url": "u"}], "next_page_token": "t1"}),
+        FakeResponse({"resources": [{"id": "b"}], "next_page_token": "t2"}),
+        FakeResponse({"resources": [{"id": "c"}], "next_page_token": None}),
+    ])
+    assert mp.find_protein_report_url(["a", "b", "c"]) == "u"
+    assert json.loads(mp.session.calls[0][1]["params"]["filter"]) == {
+        "id": {"$in": ["a", "b", "c"]},
+        "data_object_type": "Protein Report",
+    }
+    # only the page being prefetched while the first one was scanned was requested
+    assert len(mp.session.calls) == 2
+
+
+class FakeStreamResponse():
+    """Stands in for a streamed requests.Response, serving the body from its raw stream"""
+
+    def __init__(self, text):
+        self.raw = HTTPResponse(body=io.BytesIO(text.encode()), preload_content=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+
+def test_read_url_tsv_streams_rows():
+    mp = make_agg([FakeStreamResponse(
+        "KO\tCOG\tproduct\tSummedSpectraCounts\n"
+        "KO:K00031\tCOG0538\tisocitrate\x1cdehydrogenase\t5\n"
+        "\n"
+        # only real row breaks end a row, not other line-break characters or quoted newlines
+        '\tCOG0539\t"line\nbreak"\u2028\t2\n'
+    )])
+    rows = mp.read_url_tsv("https://example.org/report.tsv")
+    assert mp.session.calls == []
+    assert list(rows) == [
+        {"KO": "KO:K00031", "COG": "COG0538", "product": "isocitrate\x1cdehydrogenase", "SummedSpectraCounts": "5"},
+        {"KO": "", "COG": "COG0539", "product": "line\nbreak\u2028", "SummedSpectraCounts": "2"},
+    ]
+    assert mp.session.calls[0][1]["stream"] is True
+
+
+def test_load_protein_report_urls():
+    mp = make_agg([
+        FakeResponse({"resources": [{"id": "nmdc:dobj-2", "url": "report-1"}, {"id": "nmdc:dobj-4", "url": "report-2"}]}),
+    ])
+    mp.load_protein_report_urls([
+        {"id": "nmdc:wfmp-1", "has_output": ["nmdc:dobj-1", "nmdc:dobj-2"]},
+        {"id": "nmdc:wfmp-2", "has_output": ["nmdc:dobj-3", "nmdc:dobj-4", "nmdc:dobj-1"]},
+    ])
+    assert json.loads(mp.session.calls[0][1]["params"]["filter"]) == {
+        "id": {"$in": ["nmdc:dobj-1", "nmdc:dobj-2", "nmdc:dobj-3", "nmdc:dobj-4"]},
+        "data_object_type": "Protein Report",
+    }
+
+    # find_protein_report_url no longer queries the API
+    assert mp.find_protein_report_url(["nmdc:dobj-3", "nmdc:dobj-4"]) == "report-2"
+    assert mp.find_protein_report_url(["nmdc:dobj-5"]) is None
+    assert len(mp.session.calls) == 1
+
+
+def test_load_protein_report_urls_with_failing_chunk(monkeypatch):
+    mp = make_agg()
+    monkeypatch.setattr(mp, "_DATA_OBJECT_CHUNK_SIZE", 2)
+    iter_results = mp._iter_results
+    failures = [ValueError("Expecting value: line 1 column 1 (char 0)")]
+
+    def flaky_iter_results(collection, filter="", **kwargs):
+        # the batched request for the second chunk fails once, e.g. on an error page
+        if "nmdc:dobj-3" in json.loads(filter)["id"]["$in"] and failures:
+            raise failures.pop()
+        return iter_results(collection, filter=filter, **kwargs)
+
+    monkeypatch.setattr(mp, "_iter_results", flaky_iter_results)
+    mp.session.responses.append(FakeResponse({"resources": [{"id": "nmdc:dobj-2", "url": "report-1"}]}))
+    mp.load_protein_report_urls([
+        {"id": "nmdc:wfmp-1", "has_output": ["nmdc:dobj-1", "nmdc:dobj-2"]},
+        {"id": "nmdc:wfmp-2", "has_output": ["nmdc:dobj-3", "nmdc:dobj-4"]},
+    ])
+    assert mp.protein_report_failed_ids == {"nmdc:dobj-3", "nmdc:dobj-4"}
+
+    # the workflow of the failed chunk falls back to its own lookup, the other one does not
+    assert mp.find_protein_report_url(["nmdc:dobj-1", "nmdc:dobj-2"]) == "report-1"
+    mp.session.responses.append(FakeResponse({"resources": [{"id": "nmdc:dobj-4", "url": "report-2"}]}))
+    assert mp.find_protein_report_url(["nmdc:dobj-3", "nmdc:dobj-4"]) == "report-2"
+    assert len(mp.session.calls) == 2
+
+
+def test_sweep_success(monkeypatch):
+    mp = make_agg()
+    monkeypatch.setattr(mp, "get_previously_aggregated_workflow_ids", lambda: {"nmdc:wfmp-1", "nmdc:wfmp-2"})
+    monkeypatch.setattr(mp, "get_workflow_records", lambda: [{"id": "nmdc:wfmp-1"}, {"id": "nmdc:wfmp-2"}])
+    assert mp.sweep_success()
+    monkeypatch.setattr(mp, "get_workflow_records", lambda: [{"id": "nmdc:wfmp-1"}, {"id": "nmdc:wfmp-3"}])
+    assert not mp.sweep_success()
+
+    # after a sweep only the workflows that were not aggregated yet are looked up
+    mp._aggregated_ids = {"nmdc:wfmp-1"}
+    checked = []
+    monkeypatch.setattr(mp, "is_aggregated", lambda wf_id: checked.append(wf_id) or True)
+    assert mp.sweep_success()
+    assert checked == ["nmdc:wfmp-3"]
+
+
+def test_is_aggregated():
+    mp = make_agg([
+        FakeResponse({"resources": [{"was_generated_by": "nmdc:wfmp-1"}], "next_page_token": "t1"}),
+        FakeResponse({"resources": []}),
+    ])
+    assert mp.is_aggregated("nmdc:wfmp-1")
+    assert not mp.is_aggregated("nmdc:wfmp-2")
+    assert mp.session.calls[1][1]["params"]["filter"] == '{"was_generated_by":"nmdc:wfmp-2"}'
+    assert mp.session.calls[1][1]["params"]["max_page_size"] == 1
+
+    # an API error is raised rather than reported as not aggregated
+    mp.session.responses.append(FakeResponse({"detail": "Bad Gateway"}, status_code=502))
+    with pytest.raises(requests.HTTPError):
+        mp.is_aggregated("nmdc:wfmp-3")